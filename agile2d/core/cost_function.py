@@ -1,3 +1,6 @@
+import functools
+import os
+
 import numpy as np
 import salem
 import torch
@@ -5,8 +8,72 @@ import torch
 from agile2d.core.dynamics import run_forward_core
 
 
+def _masked_square_sum(a, mask):
+    """
+    Sum of squares of a masked tensor.
+    """
+    return (a * mask).pow(2).sum()
+
+
+def _erode3(mask):
+    """
+    Erosion of a boolean mask with a 3x3 structuring element. Equivalent to
+    checking conv2d(mask, ones(3, 3)) == 9, but only needs logical ANDs of
+    shifted views.
+
+    Parameters
+    ----------
+    mask: BoolTensor
+        2D mask to be eroded
+
+    Returns
+    -------
+    BoolTensor for the interior of mask (shape reduced by 2 in each
+    dimension)
+    """
+    return (mask[:-2, :-2] & mask[:-2, 1:-1] & mask[:-2, 2:]
+            & mask[1:-1, :-2] & mask[1:-1, 1:-1] & mask[1:-1, 2:]
+            & mask[2:, :-2] & mask[2:, 1:-1] & mask[2:, 2:])
+
+
+@functools.lru_cache(maxsize=128)
+def _load_dem(filepath, mtime):
+    """
+    Reads a GeoTIFF once per file and modification time. mtime is only part
+    of the cache key, so rewritten files are read again.
+
+    Returns
+    -------
+    read-only ndarray of the data in the GeoTIFF
+    """
+    dem = salem.GeoTiff(filepath).get_vardata()
+    dem.flags.writeable = False
+    return dem
+
+
+@functools.lru_cache(maxsize=128)
+def _load_mask(filepath, mtime):
+    """
+    Reads a mask stored as .npy file once per file and modification time.
+    mtime is only part of the cache key, so rewritten files are read again.
+
+    Returns
+    -------
+    read-only ndarray of the mask
+    """
+    mask = np.load(filepath)
+    mask.flags.writeable = False
+    return mask
+
+
+def _cache_key(gdir, filename):
+    """Filepath and modification time of a file in gdir, used as cache key"""
+    filepath = gdir.get_filepath(filename)
+    return filepath, os.path.getmtime(filepath)
+
+
 def create_cost_func(gdir, data_logger=None, surface_noise=None,
-                     bed_measurements=None):
+                     bed_measurements=None, device='cpu'):
     """
     Creates a cost function based on the glacier directory.
 
@@ -18,6 +85,10 @@ def create_cost_func(gdir, data_logger=None, surface_noise=None,
         settings
     data_logger: DataLogger
         optionally logs data
+    device: str or torch.device
+        device on which the forward run and the costs are computed
+        (e.g. 'cpu' or 'cuda'). Only cost and gradient are transferred back
+        to the host
 
     Returns
     -------
@@ -25,21 +96,27 @@ def create_cost_func(gdir, data_logger=None, surface_noise=None,
     with same shape as b
     """
 
+    inv_settings = gdir.inversion_settings
+    reg_parameters = inv_settings['reg_parameters']
+    yrs_to_run = inv_settings['yrs_forward_run']
+    case = inv_settings['case']
+    mb = inv_settings['mb_forward_run']
+    if mb is None:
+        mb = case.get_mb_model()
+
     # precompute known data to avoid recomputation during each call of
-    # cost_fucntion
-    conv_filter = torch.ones((1, 1, 3, 3), requires_grad=False)
-    # TODO: think about whether cross is better suited (in forward model no diagonal transport
-    # conv_filter = torch.tensor([[[[0, 1, 0], [1, 1, 1], [0, 1, 0]]]],
-    #                           dtype=torch.float, requires_grad=True)
-    spinup_surf = salem.GeoTiff(gdir.get_filepath('spinup_dem')).get_vardata()
-    ref_surf = salem.GeoTiff(gdir.get_filepath('ref_dem')).get_vardata()
+    # cost_fucntion. Data only needed by inactive cost terms is skipped
+    spinup_surf = _load_dem(*_cache_key(gdir, 'spinup_dem'))
+    ref_surf = _load_dem(*_cache_key(gdir, 'ref_dem'))
     if surface_noise is not None:
-        spinup_surf += surface_noise
-        ref_surf += surface_noise
+        # cached arrays are read-only, noise is added to copies
+        spinup_surf = spinup_surf + surface_noise
+        ref_surf = ref_surf + surface_noise
         # TODO: allow for independent surface perturbations
 
     gpr = None
-    if bed_measurements is not None:
+    if (bed_measurements is not None and len(reg_parameters) > 5
+            and reg_parameters[5] != 0):
         # PyTorch is a bit messy with masks.
         # Instead we use full tensors and multiply by a mask.
         gpr_data = torch.tensor(np.ma.filled(bed_measurements, -9999),
@@ -47,26 +124,45 @@ def create_cost_func(gdir, data_logger=None, surface_noise=None,
                                 requires_grad=False)
         gpr_mask = torch.tensor(1 - bed_measurements.mask,
                                 dtype=torch.float, requires_grad=False)
-        gpr = (gpr_data, gpr_mask)
+        gpr = (gpr_data.to(device, non_blocking=True),
+               gpr_mask.to(device, non_blocking=True))
 
     spinup_surf = torch.tensor(spinup_surf, dtype=torch.float,
                                requires_grad=False)
     ref_surf = torch.tensor(ref_surf, dtype=torch.float,
                             requires_grad=False)
-    ref_ice_mask = np.load(gdir.get_filepath('ref_ice_mask'))
-    ref_ice_mask = torch.tensor(ref_ice_mask.astype(np.int),
-                                dtype=torch.float, requires_grad=False)
-    ref_inner_mask = torch.zeros(ref_ice_mask.shape)
-    ref_inner_mask[1:-1, 1:-1] = torch.conv2d(
-        ref_ice_mask.unsqueeze(0).unsqueeze(0), conv_filter) == 9
-
-    inv_settings = gdir.inversion_settings
-    reg_parameters = inv_settings['reg_parameters']
-    yrs_to_run = inv_settings['yrs_forward_run']
-    case = inv_settings['case']
-    mb = inv_settings['mb_forward_run']
-    if mb is None:
-        mb = case.get_mb_model()
+    # masks are loaded and eroded as bool tensors (1 byte per cell) directly
+    # on device, float versions are only created for masks that are
+    # multiplied with other tensors
+    ref_ice_mask_bool = torch.tensor(
+        _load_mask(*_cache_key(gdir, 'ref_ice_mask')), dtype=torch.bool
+    ).to(device, non_blocking=True)
+    ref_inner_mask_bool = torch.zeros_like(ref_ice_mask_bool)
+    # TODO: think about whether cross is better suited for the erosion (in
+    # forward model no diagonal transport)
+    ref_inner_mask_bool[1:-1, 1:-1] = _erode3(ref_ice_mask_bool)
+    # masks derived from the reference state are the same for every call
+    ref_ice_mask = ref_ice_mask_bool.float()
+    ref_margin = (ref_ice_mask_bool & ~ref_inner_mask_bool).float()
+    ref_outer_mask = (~ref_ice_mask_bool).float()
+
+    # everything needed during each call of cost_function lives on device
+    spinup_surf = spinup_surf.to(device, non_blocking=True)
+    ref_surf = ref_surf.to(device, non_blocking=True)
+
+    # the surface misfit only contributes on glacier cells, so their indices
+    # and the reference values on them are gathered once
+    ice_idx = torch.nonzero(ref_ice_mask_bool.flatten()).squeeze(1)
+    ref_ice_cells = (ice_idx, ref_surf.flatten()[ice_idx],
+                     ref_inner_mask_bool.flatten()[ice_idx].float(),
+                     ref_margin.flatten()[ice_idx])
+
+    # L-BFGS-B copies what it needs from each gradient, so the same array
+    # can be handed out on every call. Other solvers might keep references
+    # to previous gradients and get a new array each time
+    grad_buf = None
+    if inv_settings['solver'] == 'L-BFGS-B':
+        grad_buf = np.empty(ref_surf.numel(), dtype=np.float64)
 
     def c_fun(b):
         """
@@ -85,15 +181,16 @@ def create_cost_func(gdir, data_logger=None, surface_noise=None,
         with same shape as b
         """
         return cost_function(b, reg_parameters, ref_surf, ref_ice_mask,
-                             ref_inner_mask, spinup_surf, conv_filter,
-                             yrs_to_run, case.dx, mb, gpr, data_logger)
+                             ref_ice_cells, ref_margin, ref_outer_mask,
+                             spinup_surf, yrs_to_run, case.dx, mb, gpr,
+                             data_logger, grad_buf)
 
     return c_fun
 
 
-def cost_function(b, reg_parameters, ref_surf, ref_ice_mask, ref_inner_mask,
-                  spinup_surf, conv_filter, yrs_to_run, dx, mb,
-                  gpr=None, data_logger=None):
+def cost_function(b, reg_parameters, ref_surf, ref_ice_mask, ref_ice_cells,
+                  ref_margin, ref_outer_mask, spinup_surf, yrs_to_run, dx, mb,
+                  gpr=None, data_logger=None, grad_buf=None):
     """
     Calculates cost for a given bed and other given parameters.
 
@@ -109,13 +206,18 @@ def cost_function(b, reg_parameters, ref_surf, ref_ice_mask, ref_inner_mask,
     ref_ice_mask: FloatTensor
         Tensor containing only 1's and 0's masking everything outside the
         glacier (border is included)
-    ref_inner_mask: FloatTensor
+    ref_ice_cells: tuple of (LongTensor, FloatTensor, FloatTensor, FloatTensor)
+        Flat indices of all cells inside ref_ice_mask and, on these cells
+        only, ref_surf, the inner mask of the glacier (border is excluded)
+        and ref_margin
+    ref_margin: FloatTensor
         Tensor containing only 1's and 0's masking everything except the
-        interior of the glacier (border is excluded)
+        border of the glacier (ref_ice_mask - ref_inner_mask)
+    ref_outer_mask: FloatTensor
+        Tensor containing only 1's and 0's masking the glacier
+        (1 - ref_ice_mask)
     spinup_surf: FloatTensor
         Surface height after spinup (unit: [m])
-    conv_filter: FloatTensor
-        Precomputed FloatTensor for convolution to create inner_masks
     yrs_to_run: float
         years to run for forward modeling (unit: [a])
     dx: float
@@ -124,63 +226,79 @@ def cost_function(b, reg_parameters, ref_surf, ref_ice_mask, ref_inner_mask,
         Model for the mass-balance needed in the forward run
     data_logger: DataLogger
         optionally logs data
+    grad_buf: ndarray
+        optional float64 array with as many elements as b. If given, the
+        gradient is written into it and returned instead of a new array
 
     Returns
     -------
     tuple of (cost, grad) with cost as float and grad being a ndarray
     with same shape as b
     """
-    guessed_bed = torch.tensor(b.reshape(ref_surf.shape), dtype=torch.float,
-                               requires_grad=True)
+    # from_numpy only creates a view on b, so converting it to the float
+    # tensor on the target device is the only copy made.
+    # Everything is kept in float32 on purpose: bfloat16/float16 cannot
+    # resolve metre-scale differences of surface and bed heights of
+    # several thousand metres, and 0/1 masks in reduced precision only
+    # slow down the (mixed dtype) multiplications on the CPU
+    guessed_bed = torch.from_numpy(b.reshape(ref_surf.shape)).to(
+        device=ref_surf.device, dtype=torch.float).requires_grad_(True)
 
     # run model forward
     init_ice_thick = spinup_surf - guessed_bed
     model_surf = run_forward_core(yrs_to_run, guessed_bed, dx, mb,
                                   init_ice_thick)
-    model_ice_mask = ((model_surf - guessed_bed) > 0.).type(
-        dtype=torch.float)
-    model_inner_mask = torch.zeros(model_ice_mask.shape)
-    model_inner_mask[1:-1, 1:-1] = torch.conv2d(
-        model_ice_mask.unsqueeze(0).unsqueeze(0), conv_filter) == \
-                                   conv_filter.sum()
+    # masks are not differentiable, model_ice_mask can stay boolean and only
+    # model_inner_mask is needed as float for the cost terms
+    model_ice_mask = (model_surf - guessed_bed) > 0.
+    model_inner_mask = torch.zeros_like(model_surf)
+    model_inner_mask[1:-1, 1:-1] = _erode3(model_ice_mask)
 
     # quantify costs (all terms)
-    c_terms = get_costs(reg_parameters, ref_surf, ref_ice_mask, ref_inner_mask,
-                        guessed_bed, model_surf, model_ice_mask,
-                        model_inner_mask, dx, gpr)
+    c_terms = get_costs(reg_parameters, ref_ice_cells, ref_ice_mask,
+                        ref_margin, ref_outer_mask, guessed_bed, model_surf,
+                        model_ice_mask, model_inner_mask, dx, gpr)
 
     # Calculate costs and gradient w.r.t guessed_bed
-    c = c_terms.sum()
+    c = sum(c_terms)
     c.backward()  # This is where the magic happens
     g = guessed_bed.grad  # And this is where we can now find the gradient
 
     # Format for scipy.optimize.minimize
-    grad = g.detach().numpy().reshape(b.shape).astype(np.float64)
-    cost = c.detach().numpy().astype(np.float64)
+    g = g.detach().cpu().numpy().reshape(b.shape)
+    if grad_buf is None:
+        grad = g.astype(np.float64)
+    else:
+        grad = grad_buf.reshape(b.shape)
+        np.copyto(grad, g, casting='same_kind')
+    cost = c.detach().cpu().numpy().astype(np.float64)
 
     # Do keep data for logging if desired
     if data_logger is not None:
-        data_logger.c_terms.append(c_terms.detach().numpy())
+        data_logger.c_terms.append(
+            torch.stack(c_terms).detach().cpu().numpy())
         data_logger.costs.append(cost)
-        data_logger.grads.append(grad)
-        data_logger.beds.append(guessed_bed.detach().numpy())
-        data_logger.surfs.append(model_surf.detach().numpy())
+        # grad might be grad_buf, which is overwritten by the next call
+        data_logger.grads.append(grad.copy())
+        data_logger.beds.append(guessed_bed.detach().cpu().numpy())
+        data_logger.surfs.append(model_surf.detach().cpu().numpy())
 
     return cost, grad
 
 
-def get_costs(reg_parameters, ref_surf, ref_ice_mask, ref_inner_mask, guessed_bed,
-              model_surf, model_ice_mask, model_inner_mask, dx,
-              gpr=None):
+def get_costs(reg_parameters, ref_ice_cells, ref_ice_mask, ref_margin,
+              ref_outer_mask, guessed_bed, model_surf, model_ice_mask,
+              model_inner_mask, dx, gpr=None):
     """
     TODO: Documentation
 
     Parameters
     ----------
     reg_parameters
-    ref_surf
+    ref_ice_cells
     ref_ice_mask
-    ref_inner_mask
+    ref_margin
+    ref_outer_mask
     guessed_bed
     model_surf
     model_ice_mask
@@ -190,50 +308,38 @@ def get_costs(reg_parameters, ref_surf, ref_ice_mask, ref_inner_mask, guessed_be
 
     Returns
     -------
+    list of scalar FloatTensors with one entry per reg_parameter and the
+    surface misfit inside the glacier as last entry
 
     """
-    n_inner_mask = model_inner_mask.sum()
-    n_ice_mask = ref_ice_mask.sum()
-    n_grid = ref_surf.numel()
-    margin = ref_ice_mask - ref_inner_mask
-    cost = torch.zeros(len(reg_parameters) + 1)
+    # plain list instead of a tensor to avoid an autograd node for each
+    # assignment of a cost term
+    zero = torch.zeros((), device=guessed_bed.device)
+    cost = [zero] * (len(reg_parameters) + 1)
+
+    # intermediates shared by several cost terms are only computed once,
+    # the surface misfit only on cells inside the reference glacier
+    ice_idx, ref_surf_ice, ref_inner_ice, ref_margin_ice = ref_ice_cells
+    surf_misfit = ref_surf_ice - model_surf.flatten()[ice_idx]
 
     # TODO recheck all indices for reg_parameters and cost
-    cost[-1] = ((ref_surf - model_surf) * ref_inner_mask).pow(2).sum()
-    cost[0] = reg_parameters[0] *\
-              ((ref_surf - model_surf) * margin).pow(2).sum()
+    cost[-1] = _masked_square_sum(surf_misfit, ref_inner_ice)
+    if reg_parameters[0] != 0:
+        cost[0] = reg_parameters[0] * _masked_square_sum(surf_misfit,
+                                                         ref_margin_ice)
 
     if reg_parameters[1] != 0:
         # penalizes ice thickness, where ice thickness should be 0
-        cost[1] = reg_parameters[1] * (((model_surf - guessed_bed)
-                                        * (1. - ref_ice_mask)).pow(2).sum())
+        cost[1] = reg_parameters[1] * _masked_square_sum(
+            model_surf - guessed_bed, ref_outer_mask)
 
-    if reg_parameters[2] != 0:
-        # penalize large derivatives of bed under glacier
-        # -> avoids numerical instabilites
-        db_dx1 = (guessed_bed[:, :-2] - guessed_bed[:, 1:-1]) / dx
-        db_dx2 = (guessed_bed[:, 1:-1] - guessed_bed[:, 2:]) / dx
-        db_dy1 = (guessed_bed[:-2, :] - guessed_bed[1:-1, :]) / dx
-        db_dy2 = (guessed_bed[1:-1, :] - guessed_bed[2:, :]) / dx
-        db_dx_sq = 0.5 * (db_dx1.pow(2) + db_dx2.pow(2)) * ref_ice_mask[:, 1:-1]
-        db_dy_sq = 0.5 * (db_dy1.pow(2) + db_dy2.pow(2)) * ref_ice_mask[1:-1, :]
-        cost[2] = reg_parameters[2] * 0.5 * ((db_dx_sq.sum() + db_dy_sq.sum()))
-                # TODO: think about first squaring forward and backward and then adding vs adding and then squaring
-                # then an additional .abs() is required for db_dx1, ...
-
-    if reg_parameters[3] != 0:
-        # penalize high curvature of bed exactly at boundary pixels of
-        # glacier for a smooth transition from glacier-free to glacier
-        ddb_dx = (guessed_bed[:, :-2] + guessed_bed[:, 2:]
-                  - 2 * guessed_bed[:, 1:-1]) / dx ** 2
-        ddb_dy = (guessed_bed[:-2, :] + guessed_bed[2:, :]
-                  - 2 * guessed_bed[1:-1, :]) / dx ** 2
-        ddb_dx = ddb_dx * margin[:, 1:-1]
-        ddb_dy = ddb_dy * margin[1:-1, :]
-        #ddb_dx = ddb_dx * ref_ice_mask[:, 1:-1]
-        #ddb_dy = ddb_dy * ref_ice_mask[1:-1, :]
-        cost[3] = reg_parameters[3] \
-                  * ((ddb_dx.pow(2).sum() + ddb_dy.pow(2).sum()))
+    if reg_parameters[2] != 0 or reg_parameters[3] != 0:
+        # both terms only depend on the bed and are evaluated together
+        # including their gradient (see BedStencilCosts)
+        bed_costs = BedStencilCosts.apply(guessed_bed, ref_ice_mask,
+                                          ref_margin, dx, reg_parameters[2],
+                                          reg_parameters[3])
+        cost[2], cost[3] = bed_costs.unbind()
 
     if len(reg_parameters) > 4 and reg_parameters[4] != 0:
         # penalize high curvature of surface in glacier bounds
@@ -241,18 +347,17 @@ def get_costs(reg_parameters, ref_surf, ref_ice_mask, ref_inner_mask, guessed_be
                   - 2 * model_surf[:, 1:-1]) / dx ** 2
         dds_dy = (model_surf[:-2, :] + model_surf[2:, :]
                   - 2 * model_surf[1:-1, :]) / dx ** 2
-        dds_dx = dds_dx * model_inner_mask[:, 1:-1]
-        dds_dy = dds_dy * model_inner_mask[1:-1, :]
         cost[4] = reg_parameters[4] \
-                  * ((dds_dx.pow(2).sum() + dds_dy.pow(2).sum()))
+                  * (_masked_square_sum(dds_dx, model_inner_mask[:, 1:-1])
+                     + _masked_square_sum(dds_dy, model_inner_mask[1:-1, :]))
     
     if gpr is not None and reg_parameters[5] != 0:
         # penalize large deviations from bed measurements
         # bed measurements should be given as two tensors, one for the data
         # and one for the mask
         gpr_data, gpr_mask = gpr
-        cost[5] = reg_parameters[5] * ((guessed_bed - gpr_data)
-                                       * gpr_mask).pow(2).sum()
+        cost[5] = reg_parameters[5] * _masked_square_sum(
+            guessed_bed - gpr_data, gpr_mask)
 
     """
     if reg_parameters[3] != 0:
@@ -326,6 +431,92 @@ def get_costs(reg_parameters, ref_surf, ref_ice_mask, ref_inner_mask, guessed_be
     return cost
 
 
+class BedStencilCosts(torch.autograd.Function):
+    """
+    Costs for large derivatives of the bed under the glacier
+    (reg_parameters[2]) and for high curvature of the bed at the glacier
+    margin (reg_parameters[3]).
+
+    Both terms are quadratic in the bed, so their derivatives are known in
+    closed form. They are computed in the same pass as the costs, which
+    avoids building an autograd graph for each of the stencil operations.
+    """
+    @staticmethod
+    def forward(ctx, bed, ice_mask, margin, dx, lambda_grad, lambda_curv):
+        costs = torch.zeros(2, dtype=bed.dtype, device=bed.device)
+        grads = torch.zeros((2,) + bed.shape, dtype=bed.dtype,
+                            device=bed.device)
+
+        # neighbour views are shared by both terms
+        b_l = bed[:, :-2]
+        b_cx = bed[:, 1:-1]
+        b_r = bed[:, 2:]
+        b_u = bed[:-2, :]
+        b_cy = bed[1:-1, :]
+        b_d = bed[2:, :]
+
+        if lambda_grad != 0:
+            # penalize large derivatives of bed under glacier
+            # -> avoids numerical instabilites
+            # masks only contain 0 and 1, so the differences are masked once
+            # and reused for the costs and their derivatives
+            ice_mask_x = ice_mask[:, 1:-1]
+            ice_mask_y = ice_mask[1:-1, :]
+            db_dx1 = (b_l - b_cx) / dx * ice_mask_x
+            db_dx2 = (b_cx - b_r) / dx * ice_mask_x
+            db_dy1 = (b_u - b_cy) / dx * ice_mask_y
+            db_dy2 = (b_cy - b_d) / dx * ice_mask_y
+            db_dx_sq = 0.5 * (db_dx1.pow(2) + db_dx2.pow(2))
+            db_dy_sq = 0.5 * (db_dy1.pow(2) + db_dy2.pow(2))
+            costs[0] = lambda_grad * 0.5 * (db_dx_sq.sum() + db_dy_sq.sum())
+            # TODO: think about first squaring forward and backward and then adding vs adding and then squaring
+            # then an additional .abs() is required for db_dx1, ...
+
+            # derivatives of costs[0] w.r.t. the one-sided differences,
+            # already divided by dx for the chain rule
+            w = 0.5 * lambda_grad / dx
+            g_dx1 = w * db_dx1
+            g_dx2 = w * db_dx2
+            g_dy1 = w * db_dy1
+            g_dy2 = w * db_dy2
+            grads[0, :, :-2] += g_dx1
+            grads[0, :, 1:-1] += g_dx2 - g_dx1
+            grads[0, :, 2:] -= g_dx2
+            grads[0, :-2, :] += g_dy1
+            grads[0, 1:-1, :] += g_dy2 - g_dy1
+            grads[0, 2:, :] -= g_dy2
+
+        if lambda_curv != 0:
+            # penalize high curvature of bed exactly at boundary pixels of
+            # glacier for a smooth transition from glacier-free to glacier
+            ddb_dx = (b_l + b_r - 2 * b_cx) / dx ** 2 * margin[:, 1:-1]
+            ddb_dy = (b_u + b_d - 2 * b_cy) / dx ** 2 * margin[1:-1, :]
+            costs[1] = lambda_curv * (ddb_dx.pow(2).sum()
+                                      + ddb_dy.pow(2).sum())
+
+            # derivatives of costs[1] w.r.t. the curvatures, already divided
+            # by dx ** 2 for the chain rule. ddb_dx and ddb_dy are already
+            # masked by the margin, which only contains 0 and 1
+            w = 2. * lambda_curv / dx ** 2
+            h_x = w * ddb_dx
+            h_y = w * ddb_dy
+            grads[1, :, :-2] += h_x
+            grads[1, :, 1:-1] -= 2. * h_x
+            grads[1, :, 2:] += h_x
+            grads[1, :-2, :] += h_y
+            grads[1, 1:-1, :] -= 2. * h_y
+            grads[1, 2:, :] += h_y
+
+        ctx.save_for_backward(grads)
+        return costs
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grads, = ctx.saved_tensors
+        grad_bed = (grad_output.view(2, 1, 1) * grads).sum(0)
+        return grad_bed, None, None, None, None, None
+
+
 class LocalMeanSquaredDifference(torch.autograd.Function):
     """
     More or less test class for own functions on tensors with custom
@@ -335,14 +526,18 @@ class LocalMeanSquaredDifference(torch.autograd.Function):
     """
     @staticmethod
     def forward(ctx, modelled_surf, surface_to_match, ice_region, ice_mask, bed):
-        ctx.save_for_backward(modelled_surf, surface_to_match, ice_region, ice_mask, bed)
-        msd = (modelled_surf - surface_to_match).pow(2).sum() / ice_region.sum().type(dtype=torch.float)
+        diff = modelled_surf - surface_to_match
+        n = ice_region.sum().to(modelled_surf.dtype)
+        ctx.save_for_backward(diff, ice_mask, n)
+        msd = diff.pow(2).sum() / n
         return msd
 
     @staticmethod
     def backward(ctx, grad_output):
-        modelled_surf, observed_surf, ice_region, ice_mask, bed = ctx.saved_tensors
-        grad_modelled_surf = (modelled_surf - observed_surf) * ice_mask
+        diff, ice_mask, n = ctx.saved_tensors
+        # gradient is handed to the bed directly, i.e. the surface is
+        # assumed to follow changes of the bed
+        grad_modelled_surf = grad_output * 2. * diff * ice_mask / n
         return None, None, None, None, grad_modelled_surf
 
 
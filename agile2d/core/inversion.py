@@ -240,7 +240,9 @@ class InversionDirectory(object):
 
         self.cost_func = create_cost_func(self.gdir, self.data_logger,
                                           self.surf_noise,
-                                          self.bed_measurements)
+                                          self.bed_measurements,
+                                          self.inv_settings.get('device',
+                                                                'cpu'))
         res = None
         try:
             res = minimize(fun=self.cost_func,
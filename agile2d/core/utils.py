@@ -216,7 +216,7 @@ class NonRGIGlacierDirectory(GlacierDirectory):
                                  reg_parameters=DEFAULT_REG_PARAMETERS,
                                  solver='L-BFGS-B', minimize_options=None,
                                  inversion_subdir='0', log_minimize_steps=True,
-                                 bounds_min_max=None):
+                                 bounds_min_max=None, device='cpu'):
         """
         TODO: Documentation
 
@@ -231,6 +231,7 @@ class NonRGIGlacierDirectory(GlacierDirectory):
         minimize_options
         inversion_counter
         log_minimize_steps
+        device
 
         Returns
         -------